@@ -22,7 +22,8 @@ setup(
         packages=['syncthingmanager'],
         install_requires=['syncthing>=2.0.2'],
         extras_require={
-            'test': ['pytest']
+            'test': ['pytest'],
+            'speedups': ['orjson; python_version >= "3.8"'],
         },
         entry_points={
             'console_scripts': [
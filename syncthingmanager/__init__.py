@@ -15,23 +15,19 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from syncthing import Syncthing, SyncthingError
-from argparse import ArgumentParser
-import configparser
-import pathlib
 import sys
 import os
-from xml.etree.ElementTree import parse
-from textwrap import dedent
-import platform
 from math import floor
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from time import monotonic
 
 # Put globals here
 __VERSION__ = '0.1.0'
 __DEFAULT_CONFIG_LOCATION__ = '$HOME/.config/syncthingmanager/syncthingmanager.conf'
-if platform.system() == 'Windows':
+if sys.platform == 'win32':
     __DEFAULT_ST_CONFIG_LOCATION__ = '%localappdata%/Syncthing/config.xml'
-elif platform.system() == 'Darwin':
+elif sys.platform == 'darwin':
     __DEFAULT_ST_CONFIG_LOCATION__ = '$HOME/Library/Application Support/Syncthing/config.xml'
 else:
     __DEFAULT_ST_CONFIG_LOCATION__ = '$HOME/.config/syncthing/config.xml'
@@ -43,64 +39,437 @@ OKGREEN = '\033[92m'
 WARNING = '\033[93m'
 FAIL = '\033[91m'
 ENDC = '\033[0m'
+CONNECTED_TAG = OKGREEN + 'Connected' + ENDC
+NOT_CONNECTED_TAG = FAIL + 'Not Connected' + ENDC
 
 
 class SyncthingManagerError(Exception):
     pass
 
 
-class SyncthingManager(Syncthing):
-    def device_info(self, devicestr):
+DeviceInfo = namedtuple('DeviceInfo', ['id', 'index', 'folders', 'name'])
+FolderInfo = namedtuple('FolderInfo', ['id', 'index', 'label', 'devices'])
+APIInfo = namedtuple('APIInfo', ['apikey', 'hostname', 'port'])
+
+
+# Output of the list and info commands
+_SELF_TMPL = """\
+{0}     This Device
+    ID:     {1}
+
+"""
+_CONNECTED_TMPL = """\
+{0}     {1}
+    At:     {2}
+    Folders:    {3}
+    ID:     {4}
+
+"""
+_NOT_CONNECTED_TMPL = """\
+{0}     {1}
+    Folders:    {2}
+    ID:     {3}
+
+"""
+_DEVICE_INFO_TMPL = """\
+{0}
+    Addresses:     {1}
+    Folders:    {2}
+    ID:     {3}
+    Introducer?     {4}
+"""
+_FOLDER_TMPL = """\
+{0}     {4}%
+    Shared With:  {1}
+    Folder ID:  {2}
+    Folder Path:    {3}
+
+"""
+_FOLDER_INFO_TMPL = """\
+{0}     {4}%
+    Shared With:  {1}
+    Folder ID:  {2}
+    Folder Path:    {3}"""
+
+# Versioning type -> (label, parameter) shown by folder info
+_VERSIONING_FIELDS = {
+    'trashcan': ('Clean out after:    ', 'cleanoutDays'),
+    'simple': ('Keep Versions:      ', 'keep'),
+    'staggered': ('Versions Path:      ', 'versionsPath'),
+    'external': ('Command:            ', 'command'),
+}
+
+
+def _build_indices(config):
+    """ Builds lookup tables for the devices and folders in a configuration,
+    so that finding one does not mean scanning the whole config.
+
+    Args:
+
+        config (dict): the configuration as returned by ``system.config()``.
+
+    Returns:
+
+        dict:
+
+            devices_by_id: deviceID -> (index in config['devices'], device)
+
+            devices_by_name: device name -> (index, device) of the first
+                device with that name
+
+            device_names: deviceID -> device name
+
+            folder_device_index: (folder ID, deviceID) -> index of the
+                device in the folder's list of devices
+
+            folders_by_device: deviceID -> list of the folder IDs shared with
+                the device
+
+            folders_by_id: folder ID -> (index in config['folders'], folder)
+
+            folders_by_label: folder label -> (index, folder) of the first
+                folder with that label. Unlabelled folders are left out. """
+    devices_by_id = {}
+    devices_by_name = {}
+    device_names = {}
+    for index, device in enumerate(config['devices']):
+        devices_by_id[device['deviceID']] = (index, device)
+        devices_by_name.setdefault(device['name'], (index, device))
+        device_names[device['deviceID']] = device['name']
+    folder_device_index = {}
+    folders_by_device = defaultdict(list)
+    folders_by_id = {}
+    folders_by_label = {}
+    for index, folder in enumerate(config['folders']):
+        folders_by_id[folder['id']] = (index, folder)
+        if folder['label']:
+            folders_by_label.setdefault(folder['label'], (index, folder))
+        for position, d in enumerate(folder['devices']):
+            folder_device_index[(folder['id'], d['deviceID'])] = position
+            folders_by_device[d['deviceID']].append(folder['id'])
+    return {'devices_by_id': devices_by_id, 'devices_by_name': devices_by_name,
+            'device_names': device_names,
+            'folder_device_index': folder_device_index,
+            'folders_by_device': folders_by_device,
+            'folders_by_id': folders_by_id, 'folders_by_label': folders_by_label}
+
+
+# orjson.loads, False if orjson isn't installed, None until first needed
+_orjson_loads = None
+
+
+def _parse_json(resp):
+    """ Parses the JSON body of a response, using orjson when it is installed
+    (``pip install syncthingmanager[speedups]``), which is several times
+    faster than ``json`` on large configurations. """
+    global _orjson_loads
+    if _orjson_loads is None:
+        # Only tried once, since a failed import searches sys.path each time
+        try:
+            from orjson import loads as _orjson_loads
+        except ImportError:
+            _orjson_loads = False
+    if not _orjson_loads:
+        return resp.json()
+    return _orjson_loads(resp.content)
+
+
+class _SessionRequests(object):
+    """ Stands in for the ``requests`` module inside ``syncthing``. The
+    client calls ``requests.request()`` for every API call, which opens a new
+    connection each time; this sends them through one keep-alive session. """
+    def __init__(self, requests, session):
+        self._requests = requests
+        self._session = session
+
+    def request(self, method, url, **kwargs):
+        return self._session.request(method, url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._requests, name)
+
+
+def _pool_connections():
+    """ Makes the ``syncthing`` client reuse pooled HTTP connections. """
+    import syncthing
+    if isinstance(syncthing.requests, _SessionRequests):
+        return
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    # Room for the parallel fetches of _fetch_state, plus a few daemons
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    syncthing.requests = _SessionRequests(requests, session)
+
+
+class SyncthingManager(object):
+    """ High-level methods for a Syncthing daemon. Takes the same arguments
+    as ``syncthing.Syncthing``, and the client's attributes (``system``,
+    ``db``, ``misc``...) are available on the instance. """
+    # Seconds for which a cached config, status or connections response is
+    # reused instead of asking the daemon again.
+    _CACHE_TTL = 2
+
+    def __init__(self, *args, **kwargs):
+        # syncthing imports requests, which is slow to load and not needed by
+        # ``stman configure`` or ``--help``, so it is only imported here.
+        from syncthing import Syncthing
+        self._client = Syncthing(*args, **kwargs)
+        _pool_connections()
+        # system endpoint name -> (monotonic() when fetched, response)
+        self._cache = {}
+        # (ETag or body digest of the last config response, its parsed dict)
+        self._config_validator = (None, None)
+        # (config, the indices built from it)
+        self._indices = (None, None)
+        # devicestr -> normalized device ID, or None if it isn't one
+        self._devid_cache = {}
+        # (config, user string, result) of the last device_info/folder_info
+        # call, since an action usually resolves the same string repeatedly
+        self._last_device_lookup = (None, None, None)
+        self._last_folder_lookup = (None, None, None)
+        # nesting depth of batch() blocks, the config they will set, and
+        # whether any of them raised
+        self._batch_depth = 0
+        self._pending_config = None
+        self._batch_failed = False
+
+    def __getattr__(self, name):
+        if name == '_client':
+            raise AttributeError(name)
+        return getattr(self._client, name)
+
+    def _cached(self, endpoint, force=False):
+        """ Returns the response of ``system.<endpoint>()``, only asking the
+        daemon again once the cached one is older than ``_CACHE_TTL``.
+
+        Args:
+
+            endpoint (str): ``config``, ``status`` or ``connections``.
+
+            force (bool): discard the cached response and fetch it again. """
+        if endpoint == 'config' and self._pending_config is not None:
+            # Changes made inside batch() haven't been set yet
+            return self._pending_config
+        entry = self._cache.get(endpoint)
+        if force or not self._is_fresh(entry, monotonic()):
+            if force and endpoint == 'config':
+                # Don't reuse a dict that may have been modified in place
+                self._config_validator = (None, None)
+            response = self._fetcher(endpoint)()
+            # Stamped once received, so a slow response isn't already stale
+            entry = self._cache[endpoint] = (monotonic(), response)
+        return entry[1]
+
+    def _fetcher(self, endpoint):
+        if endpoint == 'config':
+            return self._fetch_config
+        return getattr(self.system, endpoint)
+
+    def _is_fresh(self, entry, now):
+        return entry is not None and now - entry[0] <= self._CACHE_TTL
+
+    def _fetch_state(self, *endpoints):
+        """ Like ``_cached`` for several endpoints at once. The responses that
+        have to be fetched are requested in parallel, so a command needing the
+        config, status and connections waits for one round trip, not three.
+
+        Args:
+
+            endpoints (str): ``config``, ``status`` or ``connections``.
+
+        Returns:
+
+            tuple: the responses, in the order of ``endpoints``. """
+        now = monotonic()
+        stale = [e for e in endpoints
+                if not (e == 'config' and self._pending_config is not None)
+                and not self._is_fresh(self._cache.get(e), now)]
+        fetched = {}
+        if len(stale) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=len(stale)) as executor:
+                futures = [(e, executor.submit(self._fetcher(e)))
+                        for e in stale]
+            for endpoint, future in futures:
+                fetched[endpoint] = future.result()
+            now = monotonic()
+            for endpoint, response in fetched.items():
+                self._cache[endpoint] = (now, response)
+        # What was just fetched is returned as is, even if the round trip
+        # took longer than _CACHE_TTL
+        return tuple(fetched[e] if e in fetched else self._cached(e)
+                for e in endpoints)
+
+    def _fetch_config(self):
+        """ Fetches the configuration, keeping the previously parsed dict if the
+        daemon answers the last ETag it gave with a 304. Keeping the same dict
+        also keeps the indices built from it. """
+        validator, config = self._config_validator
+        headers = {}
+        if validator:
+            headers['If-None-Match'] = validator
+        resp = self.system.get('config', headers=headers, return_response=True)
+        if resp.status_code == 304 and config is not None:
+            return config
+        if resp.status_code != 200:
+            # Leave the error handling to the client
+            return self.system.config()
+        config = _parse_json(resp)
+        self._config_validator = (resp.headers.get('ETag'), config)
+        return config
+
+    def _get_config(self, force=False):
+        """ Returns the active configuration, reusing a recently fetched one.
+
+        Args:
+
+            force (bool): discard the cached configuration and fetch it again.
+
+        Returns:
+
+            dict: the configuration as returned by ``system.config()``. It is
+                shared between callers, so mutate it only to pass it on to
+                ``_set_config``. """
+        return self._cached('config', force)
+
+    def _get_status(self):
+        return self._cached('status')
+
+    def _get_connections(self):
+        return self._cached('connections')
+
+    def _get_indices(self, config):
+        """ Returns the lookup tables built by ``_build_indices`` for
+        ``config``, reusing them for as long as the same config is passed. """
+        if self._indices[0] is not config:
+            self._indices = (config, _build_indices(config))
+        return self._indices[1]
+
+    def _forget_lookups(self):
+        """ Drops everything derived from the cached config, for when it has
+        been modified in place. """
+        self._indices = (None, None)
+        self._config_validator = (None, None)
+        self._last_device_lookup = (None, None, None)
+        self._last_folder_lookup = (None, None, None)
+
+    def _set_config(self, config):
+        """ Sets the configuration and drops the cached one, which may have
+        been modified in place and lacks the defaults the daemon fills in on
+        save; the next read fetches the daemon's copy. Inside ``batch()`` the
+        config is only kept until the block exits. """
+        self._forget_lookups()
+        if self._batch_depth:
+            self._pending_config = config
+            return
+        try:
+            self.system.set_config(config)
+        finally:
+            self._cache.pop('config', None)
+
+    @contextmanager
+    def batch(self):
+        """ A context manager that sets the configuration changes made inside
+        it with a single API call when the block exits, instead of one call
+        per change. Nested blocks are set by the outermost one. If any block
+        raises, the whole batch fails: nothing is set when the outermost block
+        exits, including changes made after an outer block caught the
+        exception and carried on.
+
+        Example:
+
+            with st.batch():
+                st.folder_set_label('default', 'Default')
+                st.folder_set_rescan('default', 120)
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._batch_failed = True
+            raise
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                config, self._pending_config = self._pending_config, None
+                failed, self._batch_failed = self._batch_failed, False
+                if failed:
+                    if config is not None:
+                        # The pending config holds the abandoned changes in place
+                        self._cache.pop('config', None)
+                        self._forget_lookups()
+                elif config is not None:
+                    self._set_config(config)
+
+    def device_info(self, devicestr, config=None):
         """ A helper for finding a device ID from a user string that may be a
-        deviceID a device name.
+        deviceID or a device name. Configured IDs and names are matched
+        first; anything else is parsed as a device ID by the daemon.
 
         Args:
             devicestr (str): the string that may be a deviceID or configured
                 device name.
 
+            config (dict): an already fetched configuration to search.
+                default: the cached configuration.
+
         Returns:
-            dict:
+            DeviceInfo: a named tuple of
 
-                id: The deviceID in modern format, or None if not recogized.
+                id: The deviceID in modern format, or None if not recognized.
 
                 index: the index of the device in config['devices'] in the
                     current configuration, or None if not configured.
 
-                folders: a list of folder IDs associated with the device."""
-
+                folders: a list of folder IDs associated with the device.
+
+                name: the configured device name, or None if not configured."""
+        if config is None:
+            config = self._get_config()
+        last_config, last_str, last_info = self._last_device_lookup
+        if last_config is config and last_str == devicestr:
+            return last_info
+        info = self._device_info(devicestr, config)
+        self._last_device_lookup = (config, devicestr, info)
+        return info
+
+    def _device_info(self, devicestr, config):
+        indices = self._get_indices(config)
+        # A configured ID or name is answered from the config; only other
+        # strings are sent to the daemon to be parsed as a device ID.
+        hit = (indices['devices_by_id'].get(devicestr) or
+                indices['devices_by_name'].get(devicestr))
+        device_id = None
+        if not hit:
+            device_id = self._device_id(devicestr)
+            hit = indices['devices_by_id'].get(device_id)
+        if not hit:
+            return DeviceInfo(device_id, None, [], None)
+        index, device = hit
+        return DeviceInfo(device['deviceID'], index,
+                list(indices['folders_by_device'].get(device['deviceID'], [])),
+                device['name'])
+
+    def _device_id(self, devicestr):
+        """ Returns the device ID in modern format parsed from ``devicestr``
+        by the daemon, or None if it isn't a device ID. Results are kept for
+        the life of the instance. """
+        from syncthing import SyncthingError
+        try:
+            return self._devid_cache[devicestr]
+        except KeyError:
+            pass
         try:
             device_id = self.misc.device_id(devicestr)
         except SyncthingError:
             device_id = None
-        deviceindex = None
-        device_name = None
-        config = self.system.config()
-        folders = []
-        if not device_id:
-            for index, device in enumerate(config['devices']):
-                if devicestr == device['name']:
-                    device_name = device['name']
-                    device_id = device['deviceID']
-                    deviceindex = index
-                    for folder in config['folders']:
-                        for d in folder['devices']:
-                            if d['deviceID'] == device_id:
-                                folders.append(folder['id'])
-                    break
-        else:
-            for index, device in enumerate(config['devices']):
-                if device_id == device['deviceID']:
-                    deviceindex = index
-                    device_name = device['name']
-                    for folder in config['folders']:
-                        for d in folder['devices']:
-                            if device['deviceID'] == d['deviceID']:
-                                folders.append(folder['id'])
-                    break
-        return {'id': device_id, 'index': deviceindex, 'folders': folders,
-                'name': device_name}
-
-    def folder_info(self, folderstr):
+        self._devid_cache[devicestr] = device_id
+        return device_id
+
+    def folder_info(self, folderstr, config=None):
         """Looks for a configured folder based on a user-input string and
         returns some useful info about it. Looks for a matching ID first,
         only considers labels if none is found. Further, duplicate labels
@@ -110,9 +479,12 @@ class SyncthingManager(Syncthing):
 
             folderstr (str): the folder ID or label
 
+            config (dict): an already fetched configuration to search.
+                default: the cached configuration.
+
         returns:
 
-            dict:
+            FolderInfo: a named tuple of
 
                 id: (str) the folder ID
 
@@ -123,24 +495,20 @@ class SyncthingManager(Syncthing):
                 devices: (list) the deviceIDs associated with the folder
 
             None if no matching folder found """
-        config = self.system.config()
-        for index, folder in enumerate(config['folders']):
-            if folder['id'] == folderstr:
-                info = dict()
-                info['id'] = folder['id']
-                info['index'] = index
-                info['label'] = folder['label']
-                info['devices'] = folder['devices']
-                return info
-        for index, folder in enumerate(config['folders']):
-            if folder['label'] == folderstr:
-                info = dict()
-                info['id'] = folder['id']
-                info['index'] = index
-                info['label'] = folder['label']
-                info['devices'] = folder['devices']
-                return info
-        return None
+        if config is None:
+            config = self._get_config()
+        last_config, last_str, hit = self._last_folder_lookup
+        if not (last_config is config and last_str == folderstr):
+            indices = self._get_indices(config)
+            hit = (indices['folders_by_id'].get(folderstr) or
+                    indices['folders_by_label'].get(folderstr))
+            self._last_folder_lookup = (config, folderstr, hit)
+        if not hit:
+            return None
+        index, folder = hit
+        # A copy, so callers can't change the cached config by accident
+        return FolderInfo(folder['id'], index, folder['label'],
+                list(folder['devices']))
 
     def daemon_pause(self, device):
         """ Pause one or all devices.
@@ -151,8 +519,9 @@ class SyncthingManager(Syncthing):
 
             Returns:
                 None """
-        device_id = self.device_info(device)['id']
+        device_id = self.device_info(device).id
         r = self.system.pause(device_id)
+        self._cache.pop('connections', None)
         if r['error']:
             raise SyncthingManagerError(r['error'])
 
@@ -164,8 +533,9 @@ class SyncthingManager(Syncthing):
 
             Returns:
                 None """
-        device_id = self.device_info(device)['id']
+        device_id = self.device_info(device).id
         r = self.system.resume(device_id)
+        self._cache.pop('connections', None)
         if r['error']:
             raise SyncthingManagerError(r['error'])
 
@@ -190,20 +560,18 @@ class SyncthingManager(Syncthing):
         Returns:
 
             None """
-        config = self.system.config()
+        config = self._get_config()
         info = self.device_info(device_id)
-        if not info['id']:
+        if not info.id:
             raise SyncthingManagerError("Bad device ID: " + device_id)
-        if isinstance(info['index'], int):
+        if isinstance(info.index, int):
             raise SyncthingManagerError("Device already configured: " + device_id)
         else:
-            addresses = [address]
-            if dynamic:
-                addresses.append('dynamic')
-            config['devices'].append({'deviceID': info['id'], 'name': name,
+            addresses = [address, 'dynamic'] if dynamic else [address]
+            config['devices'].append({'deviceID': info.id, 'name': name,
                 'addresses': addresses, 'compression': 'metadata',
                 'certName': '', 'introducer': introducer})
-            self.system.set_config(config)
+            self._set_config(config)
 
     def remove_device(self, devicestr):
         """Removes a device from the configuration and sets it.
@@ -218,13 +586,13 @@ class SyncthingManager(Syncthing):
 
         Raises: ``SyncthingManagerError``: when the given device is not
             configured. """
-        config = self.system.config()
+        config = self._get_config()
         info = self.device_info(devicestr)
-        if info['index'] == None:
+        if info.index is None:
             raise SyncthingManagerError("Device not configured: " + devicestr)
         else:
-            del config['devices'][info['index']]
-            self.system.set_config(config)
+            del config['devices'][info.index]
+            self._set_config(config)
 
     def edit_device(self, devicestr, prop, value):
         """Changes properties of a device's configuration.
@@ -243,13 +611,13 @@ class SyncthingManager(Syncthing):
             None
 
         Raises: ``SyncthingManagerError``: when the given device is not configured."""
-        config = self.system.config()
-        info = self.device_info(devicestr)
-        if info['index'] is None:
+        config = self._get_config()
+        info = self.device_info(devicestr, config)
+        if info.index is None:
             raise SyncthingManagerError("Device not configured: " + devicestr)
         else:
-            config['devices'][info['index']][prop] = value
-            self.system.set_config(config)
+            config['devices'][info.index][prop] = value
+            self._set_config(config)
 
     def device_change_name(self, devicestr, name):
         """Set or change the name of a configured device.
@@ -270,26 +638,23 @@ class SyncthingManager(Syncthing):
 
             address(str): a tcp://address to add.
         """
-        info = self.device_info(devicestr)
-        try:
-            addresses = self.system.config()['devices'][info['index']]['addresses']
-        except TypeError:
+        config = self._get_config()
+        info = self.device_info(devicestr, config)
+        if info.index is None:
             raise SyncthingManagerError('Device not configured: ' + devicestr)
-        addresses.append(address)
-        self.edit_device(devicestr, 'addresses', addresses)
+        config['devices'][info.index]['addresses'].append(address)
+        self._set_config(config)
 
     def device_remove_address(self, devicestr, address):
         """The inverse of device_add_address."""
-        info = self.device_info(devicestr)
-        try:
-            addresses = self.system.config()['devices'][info['index']]['addresses']
-        except TypeError:
+        config = self._get_config()
+        info = self.device_info(devicestr, config)
+        if info.index is None:
             raise SyncthingManagerError('Device not configured: ' + devicestr)
-        try:
+        addresses = config['devices'][info.index]['addresses']
+        if address in addresses:
             addresses.remove(address)
-            self.edit_device(devicestr, 'addresses', addresses)
-        except ValueError:
-            pass
+            self._set_config(config)
 
     def add_folder(self, path, folderid, label='', foldertype='readwrite',
             rescan=60):
@@ -318,27 +683,25 @@ class SyncthingManager(Syncthing):
 
             ``SyncthingManagerError``: when the path is invalid
 
-            ``SyncthingManagerError``: when a folder with identical label is
+            ``SyncthingManagerError``: when a folder with identical ID is
                 already configured. """
-        config = self.system.config()
+        config = self._get_config()
         # It's allowed to have a folder ID that matches another folder's label
         # so we have to be careful about finding an in-use folder ID.
-        identicalid = lambda x: x['id'] == folderid
-        if next(filter(identicalid, config['folders']), None):
+        if folderid in self._get_indices(config)['folders_by_id']:
             raise SyncthingManagerError("The folder ID " + folderid +
                     " is already in use")
         else:
-            try:
-                path = pathlib.Path(path).resolve()
-            except FileNotFoundError:
+            abspath = os.path.abspath(os.path.expanduser(path))
+            if not os.path.isdir(abspath):
                 raise SyncthingManagerError("There was a problem with the path "
                         "entered: " + path)
-            folder = {'id': folderid, 'label': label, 'path': str(path),
+            folder = {'id': folderid, 'label': label, 'path': abspath,
                 'type': foldertype, 'rescanIntervalS': int(rescan), 'fsync': True,
                 'autoNormalize': True, 'maxConflicts': 10, 'pullerSleepS': 0,
                 'minDiskFreePct': 1}
             config['folders'].append(folder)
-            self.system.set_config(config)
+            self._set_config(config)
 
     def remove_folder(self, folderstr):
         """Removes a folder from the configuration and sets it.
@@ -355,83 +718,119 @@ class SyncthingManager(Syncthing):
         if not info:
             raise SyncthingManagerError(folderstr + " is not the ID or label "
                     "of a configured folder.")
-        config = self.system.config()
-        del config['folders'][info['index']]
-        self.system.set_config(config)
+        config = self._get_config()
+        del config['folders'][info.index]
+        self._set_config(config)
 
-    def share_folder(self, folderstr, devicestr):
-        """ Adds a device to a folder's list of devices and sets the
-        configuration.
+    def share_folder(self, folderstr, devicestrs):
+        """ Adds devices to a folder's list of devices and sets the
+        configuration once.
 
         Args:
 
             folderstr (str): an item from user input that may be the folder ID
                 or label.
 
-            devicestr (str): an item from user input that may be the device ID
-                or name.
+            devicestrs (str or list): one or a list of items from user input
+                that may be the device ID or name.
 
         Returns:
 
-            None """
-        info = self.folder_info(folderstr)
+            None
+
+        Raises: ``SyncthingManagerError``: when any of the devices is not
+            configured or already shares the folder. Nothing is changed in
+            that case. """
+        if isinstance(devicestrs, str):
+            devicestrs = [devicestrs]
+        config = self._get_config()
+        info = self.folder_info(folderstr, config)
         if not info:
             raise SyncthingManagerError(folderstr + " is not the ID or label "
                     "of a configured folder.")
-        deviceinfo = self.device_info(devicestr)
-        if deviceinfo['index'] is None:
-            raise SyncthingManagerError(devicestr + " is not a configured"
-                     " device name or ID")
-        for device in info['devices']:
-            if device['deviceID'] == deviceinfo['id']:
+        shared = self._get_indices(config)['folder_device_index']
+        devices = list(info.devices)
+        added = set()
+        for devicestr in devicestrs:
+            deviceinfo = self.device_info(devicestr, config)
+            if deviceinfo.index is None:
+                raise SyncthingManagerError(devicestr + " is not a configured"
+                         " device name or ID")
+            if (info.id, deviceinfo.id) in shared or deviceinfo.id in added:
                 raise SyncthingManagerError(devicestr + " is already "
                         "associated with " + folderstr)
-        config = self.system.config()
-        info['devices'].append(dict({'deviceID': deviceinfo['id']}))
-        config['folders'][info['index']]['devices'] = info['devices']
-        self.system.set_config(config)
+            added.add(deviceinfo.id)
+            devices.append({'deviceID': deviceinfo.id})
+        config['folders'][info.index]['devices'] = devices
+        self._set_config(config)
 
-    def unshare_folder(self, folderstr, devicestr):
-        """ Removes a device from a folder's list of devices and sets the
-                configuration.
+    def unshare_folder(self, folderstr, devicestrs):
+        """ Removes devices from a folder's list of devices and sets the
+                configuration once.
 
         Args:
 
             folderstr (str): an item from user input that may be the folder ID
                 or label.
 
-            devicestr (str): an item from user input that may be the device ID
-                or name.
+            devicestrs (str or list): one or a list of items from user input
+                that may be the device ID or name.
 
         Returns:
 
-            None """
-        info = self.folder_info(folderstr)
+            None
+
+        Raises: ``SyncthingManagerError``: when any of the devices is not
+            configured or does not share the folder. Nothing is changed in
+            that case. """
+        if isinstance(devicestrs, str):
+            devicestrs = [devicestrs]
+        config = self._get_config()
+        info = self.folder_info(folderstr, config)
         if not info:
             raise SyncthingManagerError(folderstr + " is not the ID or label "
                     "of a configured folder.")
-        deviceinfo = self.device_info(devicestr)
-        if deviceinfo['index'] is None:
-            raise SyncthingManagerError(devicestr + " is not a configured "
-                    "device name or ID")
-        config = self.system.config()
-        for index, device in enumerate(info['devices']):
-            if device['deviceID'] == deviceinfo['id']:
-                del info['devices'][index]
-                config['folders'][info['index']]['devices'] = info['devices']
-                self.system.set_config(config)
-                return
-        raise SyncthingManagerError(devicestr + " is not associated with "
-                + folderstr)
+        shared = self._get_indices(config)['folder_device_index']
+        removed = set()
+        for devicestr in devicestrs:
+            deviceinfo = self.device_info(devicestr, config)
+            if deviceinfo.index is None:
+                raise SyncthingManagerError(devicestr + " is not a configured "
+                        "device name or ID")
+            try:
+                removed.add(shared[(info.id, deviceinfo.id)])
+            except KeyError:
+                raise SyncthingManagerError(devicestr + " is not associated with "
+                        + folderstr)
+        devices = list(info.devices)
+        for position in sorted(removed, reverse=True):
+            del devices[position]
+        config['folders'][info.index]['devices'] = devices
+        self._set_config(config)
 
     def folder_edit(self, folderstr, prop, value):
-        config = self.system.config()
-        info = self.folder_info(folderstr)
-        if info['index'] is None:
+        self.folder_edit_batch(folderstr, **{prop: value})
+
+    def folder_edit_batch(self, folderstr, **changes):
+        """Changes several properties of a folder's configuration and sets it
+        once. The folder is found before any change is made, so the label can
+        be changed along with the rest.
+
+        Args:
+
+            folderstr (str): the folder ID or label.
+
+            changes: the new values, named by their properties as in the REST
+                config documentation.
+
+        Raises: ``SyncthingManagerError``: when the folder is not
+            configured."""
+        config = self._get_config()
+        info = self.folder_info(folderstr, config)
+        if not info:
             raise SyncthingManagerError("Folder not configured: " + folderstr)
-        else:
-            config['folders'][info['index']][prop] = value
-            self.system.set_config(config)
+        config['folders'][info.index].update(changes)
+        self._set_config(config)
 
     def folder_set_label(self, folderstr, label):
         self.folder_edit(folderstr, 'label', label)
@@ -474,8 +873,11 @@ class SyncthingManager(Syncthing):
         versioning = {'params': {}, 'type': ''}
         self.folder_edit(folderstr, 'versioning', versioning)
 
-    def db_folder_sync_fraction(self, folderstr):
-        folder_id = self.folder_info(folderstr)['id']
+    def db_folder_sync_fraction(self, folderstr, config=None):
+        info = self.folder_info(folderstr, config)
+        if not info:
+            raise SyncthingManagerError("Folder not configured: " + folderstr)
+        folder_id = info.id
         status = self.db.status(folder_id)
         try:
             return status['inSyncBytes'] / status['globalBytes']
@@ -485,83 +887,69 @@ class SyncthingManager(Syncthing):
             return 1
 
     def _print_device_info(self, devicestr):
-        config = self.system.config()
-        info = self.device_info(devicestr)
+        config = self._get_config()
+        info = self.device_info(devicestr, config)
         try:
-            device = config['devices'][info['index']]
+            device = config['devices'][info.index]
         except TypeError:
             raise SyncthingManagerError("Device not configured: " + devicestr)
-        folders = self.device_info(device['deviceID'])['folders']
-        outstr = """\
-                {0}
-                    Addresses:     {1}
-                    Folders:    {2}
-                    ID:     {3}
-                    Introducer?     {4}
-                """.format(device['name'], ', '.join(device['addresses']),
-                ', '.join(map(str, folders)), device['deviceID'],
+        outstr = _DEVICE_INFO_TMPL.format(device['name'],
+                ', '.join(device['addresses']),
+                ', '.join(map(str, info.folders)), device['deviceID'],
                 device['introducer'])
-        print(dedent(outstr))
+        sys.stdout.write(outstr + '\n')
 
     def _device_list(self):
         """Prints out a formatted list of devices and their state from the
             active configuration."""
-        config = self.system.config()
-        connections = self.system.connections()['connections']
-        status = self.system.status()
-        connected = []
-        not_connected = []
+        config, connections, status = self._fetch_state('config',
+                'connections', 'status')
+        connections = connections['connections']
+        connected, not_connected = [], []
         for device in config['devices']:
             if device['deviceID'] == status['myID']:
                 this_device = device
                 continue
-            elif connections[device['deviceID']]['connected']:
-                connected.append(device)
-                continue
-            else:
-                not_connected.append(device)
-        outstr = """\
-                {0}     This Device
-                    ID:     {1}
-                """.format(this_device['name'], this_device['deviceID'])
-        print(dedent(outstr))
+            # Devices the daemon hasn't picked up yet have no connection entry
+            connection = connections.get(device['deviceID'], {})
+            (connected if connection.get('connected') else
+                    not_connected).append(device)
+        # Leave out the colors when the output isn't going to a terminal
+        if sys.stdout.isatty():
+            connected_tag, not_connected_tag = CONNECTED_TAG, NOT_CONNECTED_TAG
+        else:
+            connected_tag, not_connected_tag = 'Connected', 'Not Connected'
+        folders_for = self._get_indices(config)['folders_by_device']
+        parts = []
+        parts.append(_SELF_TMPL.format(this_device['name'],
+                this_device['deviceID']))
         for device in connected:
             address = connections[device['deviceID']]['address']
-            folders = self.device_info(device['deviceID'])['folders']
-            outstr = """\
-                    {0}     {1}Connected{2}
-                        At:     {3}
-                        Folders:    {4}
-                        ID:     {5}
-                    """.format(device['name'], OKGREEN, ENDC, address,
-                    ', '.join(map(str, folders)), device['deviceID'])
-            print(dedent(outstr))
+            folders = folders_for.get(device['deviceID'], [])
+            parts.append(_CONNECTED_TMPL.format(device['name'],
+                    connected_tag, address, ', '.join(map(str, folders)),
+                    device['deviceID']))
 
         for device in not_connected:
-            folders = self.device_info(device['deviceID'])['folders']
-            outstr = """\
-                    {0}     {1}Not Connected{2}
-                        Folders:    {3}
-                        ID:     {4}
-                    """.format(device['name'], FAIL, ENDC,
-                    ', '.join(map(str, folders)), device['deviceID'])
-            print(dedent(outstr))
+            folders = folders_for.get(device['deviceID'], [])
+            parts.append(_NOT_CONNECTED_TMPL.format(device['name'],
+                    not_connected_tag, ', '.join(map(str, folders)),
+                    device['deviceID']))
+        sys.stdout.write(''.join(parts))
 
     def _print_folder_info(self, folderstr):
-        info = self.folder_info(folderstr)
-        config = self.system.config()
-        try:
-            folder = config['folders'][info['index']]
-        except TypeError:
+        config, status = self._fetch_state('config', 'status')
+        info = self.folder_info(folderstr, config)
+        if not info:
             raise SyncthingManagerError("Folder not configured: " + folderstr)
-        status = self.system.status()
-        sync_status = floor(100 * self.db_folder_sync_fraction(info['id']))
+        folder = config['folders'][info.index]
+        sync_status = floor(100 * self.db_folder_sync_fraction(info.id, config))
+        names = self._get_indices(config)['device_names']
         devices = []
         for device in folder['devices']:
             if device['deviceID'] == status['myID']:
                 continue
-            name = self.device_info(device['deviceID'])['name']
-            devices.append(name)
+            devices.append(names.get(device['deviceID'], device['deviceID']))
         if folder['label'] == '':
             folderstr = folder['id']
         else:
@@ -576,68 +964,50 @@ class SyncthingManager(Syncthing):
         if folder['order'] != 'random':
             nondefaults += ('\n    File Pull Order:  ' +
                     folder['order'])
-        if folder['versioning']['type'] != '':
-            nondefaults += ('\n    Versioning:       ' +
-                    folder['versioning']['type'])
-            if folder['versioning']['type'] == 'trashcan':
-                nondefaults += ('\n    Clean out after:    ' +
-                        folder['versioning']['params']['cleanoutDays'])
-            if folder['versioning']['type'] == 'simple':
-                nondefaults += ('\n    Keep Versions:      ' +
-                        folder['versioning']['params']['keep'])
-            if folder['versioning']['type'] == 'staggered':
-                nondefaults += ('\n    Versions Path:      ' +
-                        folder['versioning']['params']['versionsPath'])
-            if folder['versioning']['type'] == 'external':
-                nondefaults += ('\n    Command:            ' +
-                        folder['versioning']['params']['command'])
-        outstr = """\
-                {0}     {4}%
-                    Shared With:  {1}
-                    Folder ID:  {2}
-                    Folder Path:    {3}\
-                """.format(folderstr, ', '.join(map(str, devices)),
-                        folder['id'], folder['path'], str(sync_status))
-        print(dedent(outstr))
-        print(nondefaults)
+        versioning = folder['versioning']
+        if versioning['type'] != '':
+            nondefaults += ('\n    Versioning:       ' + versioning['type'])
+            field = _VERSIONING_FIELDS.get(versioning['type'])
+            if field:
+                label, param = field
+                nondefaults += '\n    ' + label + versioning['params'][param]
+        outstr = _FOLDER_INFO_TMPL.format(folderstr,
+                ', '.join(map(str, devices)), folder['id'], folder['path'],
+                str(sync_status))
+        sys.stdout.write(outstr + '\n' + nondefaults + '\n')
 
 
     def _folder_list(self):
         """Prints out a formatted list of folders from the configuration."""
-        config = self.system.config()
-        status = self.system.status()
+        config, status = self._fetch_state('config', 'status')
+        names = self._get_indices(config)['device_names']
+        parts = []
         for folder in config['folders']:
             devices = []
-            sync_status = floor(100 * self.db_folder_sync_fraction(folder['id']))
+            sync_status = floor(100 * self.db_folder_sync_fraction(folder['id'],
+                    config))
             for device in folder['devices']:
                 if device['deviceID'] == status['myID']:
                     continue
-                name = self.device_info(device['deviceID'])['name']
-                devices.append(name)
+                devices.append(names.get(device['deviceID'], device['deviceID']))
             if folder['label'] == '':
                 folderstr = folder['id']
             else:
                 folderstr = folder['label']
-            outstr = """\
-                    {0}     {4}%
-                        Shared With:  {1}
-                        Folder ID:  {2}
-                        Folder Path:    {3}
-                    """.format(folderstr, ', '.join(map(str, devices)),
-                            folder['id'], folder['path'], str(sync_status))
-            print(dedent(outstr))
+            parts.append(_FOLDER_TMPL.format(folderstr,
+                    ', '.join(map(str, devices)), folder['id'], folder['path'],
+                    str(sync_status)))
+        sys.stdout.write(''.join(parts))
 
 
-def arguments():
-    parser = ArgumentParser()
-    parser.add_argument('--config', '-c', default=__DEFAULT_CONFIG_LOCATION__,
-            help="stman configuration file")
-    parser.add_argument('--device', '-d', metavar='NAME', default='DEFAULT',
-            help="the configured API to use", dest='config_device')
-    base_subparsers = parser.add_subparsers(dest='subparser_name',
-            metavar='action')
-    base_subparsers.required = True
+# Values accepted by the command line for device and folder options
+_COMPRESSION_CHOICES = ('always', 'metadata', 'never')
+_FOLDER_TYPE_CHOICES = ('readwrite', 'readonly')
+_ORDER_CHOICES = ('random', 'alphabetic', 'smallestFirst', 'largestFirst',
+        'oldestFirst', 'newestFirst')
+
 
+def _configure_parser(base_subparsers):
     configuration_parser = base_subparsers.add_parser('configure',
             help="configure stman. If the configuration file specified in "
             "-c (or the default) does not exist, it will be created. To edit an " +
@@ -646,19 +1016,23 @@ def arguments():
             + "found in the GUI or config.xml", default=None)
     configuration_parser.add_argument('--hostname', '-a', default='localhost',
             help="the hostname to use. default localhost.")
-    configuration_parser.add_argument('--port', '-p', default='8384',
+    configuration_parser.add_argument('--port', '-p', default=8384,
             help="the port to use. Default 8384", type=int)
     configuration_parser.add_argument('--name', '-n',
             help="what to call this device. Defaults to the hostname.")
     configuration_parser.add_argument('--default', action='store_true',
             help="make this device the default.")
 
+
+def _daemon_parser(base_subparsers):
     daemon_parser = base_subparsers.add_parser('daemon', help="control synchronization activity by device or folder.")
     daemon_parser.add_argument('-p', '--pause', help="pause syncing with a device")
     daemon_parser.add_argument('-r', '--resume', help='resume syncing with a device')
     daemon_parser.add_argument('--pause-all', action='store_true', help="pause syncing with all devices")
     daemon_parser.add_argument('--resume-all', action='store_true', help="resume syncing with all devices")
 
+
+def _device_parser(base_subparsers):
     device_parser = base_subparsers.add_parser('device',
             help="work with devices")
     device_subparsers = device_parser.add_subparsers(dest='deviceparser_name',
@@ -697,12 +1071,14 @@ def arguments():
     edit_device_parser.add_argument('-r', '--remove-address', metavar='ADDRESS',
             help='remove ADDRESS from the list of hosts')
     edit_device_parser.add_argument('-c', '--compression', metavar='SETTING',
-            help='the level of compression to use', choices=['always', 'metadata', 'never'])
+            help='the level of compression to use', choices=_COMPRESSION_CHOICES)
     edit_device_parser.add_argument('-i', '--introducer', action='store_true',
             help='set the device as an introducer')
     edit_device_parser.add_argument('-io', '--introducer-off', action='store_true',
             help='toggle the introducer setting off')
 
+
+def _folder_parser(base_subparsers):
     folder_parser = base_subparsers.add_parser('folder',
             help="work with folders")
     folder_subparsers = folder_parser.add_subparsers(dest='folderparser_name',
@@ -715,7 +1091,7 @@ def arguments():
             help="the folder ID. Must match the one used on all cluster devices.")
     add_folder_parser.add_argument('--label', '-l', help="a local name for the folder")
     add_folder_parser.add_argument('--foldertype', '-t', default='readwrite',
-            help="'readwrite' or 'readonly'. Default readwrite", choices=['readwrite', 'readonly'])
+            help="'readwrite' or 'readonly'. Default readwrite", choices=_FOLDER_TYPE_CHOICES)
     add_folder_parser.add_argument('--rescan-interval', '-r', default=60, type=int,
             help='time in seconds between scanning for changes. Default 60.')
 
@@ -727,12 +1103,14 @@ def arguments():
     share_folder_parser = folder_subparsers.add_parser('share',
             help='Share a folder')
     share_folder_parser.add_argument('folder', metavar='FOLDER', help='the folder ID or label')
-    share_folder_parser.add_argument('device', metavar='DEVICE', help='the device ID or label')
+    share_folder_parser.add_argument('device', metavar='DEVICE', nargs='+',
+            help='the device IDs or names to share with')
 
     unshare_folder_parser = folder_subparsers.add_parser('unshare',
             help='Stop sharing folder with device')
     unshare_folder_parser.add_argument('folder', metavar='FOLDER', help='the folder ID or label')
-    unshare_folder_parser.add_argument('device', metavar='DEVICE', help='the device ID or name')
+    unshare_folder_parser.add_argument('device', metavar='DEVICE', nargs='+',
+            help='the device IDs or names to stop sharing with')
 
     edit_folder_parser = folder_subparsers.add_parser('edit',
             help="modify a configured folder")
@@ -744,14 +1122,14 @@ def arguments():
     edit_folder_parser.add_argument('--minfree', '-m', metavar='PERCENT', type=int,
             help='percentage of space that should be available on the disk this folder resides')
     edit_folder_parser.add_argument('--type', '-t', metavar='TYPE', dest='folder_type',
-            help='readonly or readwrite', choices=['readonly', 'readwrite'])
+            help='readonly or readwrite', choices=_FOLDER_TYPE_CHOICES)
     edit_folder_parser.add_argument('--order', '-o', metavar='ORDER',
             help='see the Syncthing documentation for all options',
-            choices=['random', 'alphabetic', 'smallestFirst', 'largestFirst',
-                     'oldestFirst', 'newestFirst'])
-    edit_folder_parser.add_argument('--ignore-permissions', action='store_true',
+            choices=_ORDER_CHOICES)
+    permissions_group = edit_folder_parser.add_mutually_exclusive_group()
+    permissions_group.add_argument('--ignore-permissions', action='store_true',
             help='ignore file permissions. Normally used on non-Unix filesystems')
-    edit_folder_parser.add_argument('--sync-permissions', action='store_true',
+    permissions_group.add_argument('--sync-permissions', action='store_true',
             help='turn on syncing file permissions.')
 
     folder_versioning_parser = folder_subparsers.add_parser('versioning',
@@ -760,11 +1138,11 @@ def arguments():
     folder_versioning_subparsers = folder_versioning_parser.add_subparsers(dest='versionparser_name',
             metavar='TYPE')
     trashcan_parser = folder_versioning_subparsers.add_parser('trashcan', help="move deleted files to .stversions")
-    trashcan_parser.add_argument('--cleanout', default='0', help="number of days to keep files in trash", type=int)
+    trashcan_parser.add_argument('--cleanout', default=0, help="number of days to keep files in trash", type=int)
     simple_parser = folder_versioning_subparsers.add_parser('simple', help="keep old versions of files in .stversions")
-    simple_parser.add_argument('--versions', default='5', help="the number of versions to keep", type=int)
+    simple_parser.add_argument('--versions', default=5, help="the number of versions to keep", type=int)
     staggered_parser = folder_versioning_subparsers.add_parser('staggered', help="specify a maximum age for versions")
-    staggered_parser.add_argument('--maxage', metavar='MAXAGE', default='365',
+    staggered_parser.add_argument('--maxage', metavar='MAXAGE', default=365,
             help="the maximum time to keep a version, in days, 0=forever", type=int)
     staggered_parser.add_argument('--path', metavar='PATH', default='', help="a custom path for storing versions")
     external_parser = folder_versioning_subparsers.add_parser('external', help="use a custom command for versioning")
@@ -776,76 +1154,256 @@ def arguments():
 
     list_folder_parser = folder_subparsers.add_parser('list', help='show a list of configured folders')
 
+
+# Builders for each action's subparsers, in the order they appear in --help
+_SUBPARSERS = (('configure', _configure_parser), ('daemon', _daemon_parser),
+        ('device', _device_parser), ('folder', _folder_parser))
+
+
+def _sniff_subcommand(argv):
+    """ Finds the action named on the command line without running the
+    parser.
+
+    Args:
+
+        argv (list): the command line arguments, without the program name.
+
+    Returns:
+
+        str: the action, or None if it is absent or preceded by anything but
+            ``--config`` and ``--device`` (in which case every action's parser
+            is needed). """
+    def takes_value(option):
+        # argparse also accepts unambiguous prefixes of long options
+        return option in ('-c', '-d') or (len(option) > 2 and
+                ('--config'.startswith(option) or '--device'.startswith(option)))
+    actions = dict(_SUBPARSERS)
+    argv = iter(argv)
+    for arg in argv:
+        if arg in actions:
+            return arg
+        if takes_value(arg):
+            next(argv, None)  # skip the option's value
+        elif not (arg[:2] in ('-c', '-d') or takes_value(arg.split('=', 1)[0])):
+            # help, an option not accounted for here, or an unknown action
+            return None
+    return None
+
+
+def arguments():
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--config', '-c', default=__DEFAULT_CONFIG_LOCATION__,
+            help="stman configuration file")
+    parser.add_argument('--device', '-d', metavar='NAME', default='DEFAULT',
+            help="the configured API to use", dest='config_device')
+    base_subparsers = parser.add_subparsers(dest='subparser_name',
+            metavar='action')
+    base_subparsers.required = True
+
+    # Only the parsers for the requested action are built; argparse spends
+    # most of the startup time constructing the rest.
+    action = _sniff_subcommand(sys.argv[1:])
+    for name, build in _SUBPARSERS:
+        if action is None or action == name:
+            build(base_subparsers)
+
     return parser.parse_args()
 
 
+def _read_st_apikey(path):
+    """ Returns the GUI API key from Syncthing's config.xml, or None if it
+    has none or can't be parsed. Parsing stops at the key rather than
+    building the whole tree, and elements already passed are cleared to keep
+    memory flat. """
+    from xml.etree.ElementTree import iterparse, ParseError
+    tags = []
+    with open(path, 'rb') as f:
+        try:
+            for event, elem in iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    tags.append(elem.tag)
+                    continue
+                # Only the key of the <gui> element directly under the root
+                if tags[1:] == ['gui', 'apikey']:
+                    return elem.text
+                tags.pop()
+                elem.clear()
+        except ParseError:
+            pass
+    return None
+
+
 def configure(configfile, apikey, hostname, port, name, default):
+    import configparser
     config = configparser.ConfigParser()
     configfile = os.path.expandvars(configfile)
     if not name:
         name = hostname
-    # Initialization of a config file
-    if not os.path.exists(configfile):
-        try:
-            os.makedirs(os.path.dirname(configfile), exist_ok=True)
-        except OSError:
-            raise SyncthingManagerError("Couldn't create a path to " + configfile)
-        config['DEFAULT'] = {}
+    # Write through a symlinked config file rather than replacing the link
+    target = os.path.realpath(configfile)
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+    except OSError:
+        raise SyncthingManagerError("Couldn't create a path to " + configfile)
+    # A missing file is simply not read
+    config.read(configfile)
+    if 'Name' not in config['DEFAULT']:
+        # Initialization of a config file
         config['DEFAULT']['Name'] = name
     if not apikey:
         try:
             stconfigfile = os.path.expandvars(__DEFAULT_ST_CONFIG_LOCATION__)
-            stconfig = parse(stconfigfile)
-            root = stconfig.getroot()
-            gui = root.find('gui')
-            apikey = gui.find('apikey').text
+            apikey = _read_st_apikey(stconfigfile)
         except FileNotFoundError:
+            apikey = None
+        if not apikey:
             raise SyncthingManagerError("Autoconfiguration failed. Please "
                     "specify the API key manually.")
-        except AttributeError:
-            raise SyncthingManagerError("Autoconfiguration failed. Please "
-                    "specify the API key manually.")
-    config.read(configfile)
     config[name] = {}
     config[name]['APIkey'] = apikey
     config[name]['Hostname'] = hostname
     config[name]['Port'] = str(port)
     if default:
         config['DEFAULT']['Name'] = name
+    # Write a temporary file and move it into place, so that an interrupted
+    # write can't leave a truncated configuration behind.
+    # The temporary file is created 0600; an existing file keeps its mode.
+    import tempfile
+    import stat
+    tmpname = None
     try:
-        with open(configfile, 'w') as cfg:
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(target),
+                prefix='.stman', suffix='.tmp', delete=False) as cfg:
+            tmpname = cfg.name
             config.write(cfg)
+        try:
+            os.chmod(tmpname, stat.S_IMODE(os.stat(target).st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(tmpname, target)
     except OSError:
+        if tmpname is not None and os.path.exists(tmpname):
+            os.remove(tmpname)
         raise SyncthingManagerError("Couldn't write to the config file " + configfile)
+    _CONFIG_CACHE.pop(os.path.abspath(configfile), None)
+    _CONFIG_CACHE.pop(target, None)
+
+
+def _read_ini(path):
+    """ Reads an INI file like the one written by ``configure()``, without
+    the cost of importing ``configparser``. As with ``configparser``, option
+    names are lowercased, ``=`` or ``:`` separate them from their values,
+    and every section inherits the options of the DEFAULT section.
+
+    Args:
+
+        path (str): the file to read.
+
+    Returns:
+
+        dict: section name -> dict of option -> value """
+    import re
+    sections = {'DEFAULT': {}}
+    section = None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if line[0] == '[' and line[-1] == ']':
+                section = sections.setdefault(line[1:-1], {})
+                continue
+            option = re.match(r'([^=:]*)[=:](.*)', line)
+            if section is not None and option:
+                section[option.group(1).strip().lower()] = option.group(2).strip()
+    for name, options in sections.items():
+        if name != 'DEFAULT':
+            sections[name] = dict(sections['DEFAULT'], **options)
+    return sections
+
+
+# absolute path -> (st_mtime_ns, sections) of the stman configurations read
+_CONFIG_CACHE = {}
+
+
+def _read_config(path):
+    """ Returns the sections of the stman configuration at ``path`` as read
+    by ``_read_ini``, only reading the file again once it has been modified.
+    The result is shared, so it must not be modified. """
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _CONFIG_CACHE.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = _CONFIG_CACHE[path] = (mtime, _read_ini(path))
+    return cached[1]
 
 
 def getAPIInfo(configfile, name='DEFAULT'):
-    if not os.path.exists(os.path.expandvars(configfile)):
+    """ Looks up the API settings of a configured Syncthing daemon.
+
+    Args:
+
+        configfile (str): the stman configuration file. Environment variables
+            are expanded.
+
+        name (str): the section of the daemon, or ``DEFAULT`` for the one
+            named by the DEFAULT section.
+
+    Returns:
+
+        APIInfo: a named tuple of ``apikey``, ``hostname`` and ``port`` (an
+            int). The parsed file is cached until it is modified.
+
+    Raises: ``SyncthingManagerError``: when the file can't be read or the
+        daemon isn't fully configured. """
+    try:
+        config = _read_config(os.path.expandvars(configfile))
+    except FileNotFoundError:
         raise SyncthingManagerError(configfile + " doesn't appear to be a valid path. Exiting.")
-    config = configparser.ConfigParser()
-    config.read(os.path.expandvars(configfile))
+    except OSError as err:
+        raise SyncthingManagerError("Couldn't read " + configfile + ": " +
+                str(err.strerror))
     if name == 'DEFAULT':
-        return config[config['DEFAULT']['Name']]
+        try:
+            name = config['DEFAULT']['name']
+            section = config[name]
+        except KeyError:
+            raise SyncthingManagerError("No Syncthing daemon is configured. Use "
+                "stman configure apikey to initialize a configuration (apikey"
+                " is in the syncthing settings and config.xml)")
+    else:
+        try:
+            section = config[name]
+        except KeyError:
+            raise SyncthingManagerError("The Syncthing daemon specified"
+                    " is not configured.")
     try:
-        return config[name]
-    except KeyError:
-        raise SyncthingManagerError("The Syncthing daemon specified"
-                " is not configured.")
+        return APIInfo(section['apikey'], section['hostname'],
+                int(section['port']))
+    except KeyError as err:
+        raise SyncthingManagerError("The configuration of " + name +
+                " is missing " + str(err))
+    except ValueError:
+        raise SyncthingManagerError("The configuration of " + name +
+                " has an invalid port: " + section['port'])
 
 
 def main():
+    args = arguments()
     try:
-        args = arguments()
         if args.subparser_name == 'configure':
             configure(args.config, args.apikey, args.hostname, args.port,
                     args.name, args.default)
             sys.exit(0)
-        if not getAPIInfo(args.config, args.config_device):
-            raise SyncthingManagerError("No Syncthing daemon is configured. Use "
-                "stman configure apikey to initialize a configuration (apikey"
-                " is in the syncthing settings and config.xml)")
-        APIInfo = getAPIInfo(args.config, args.config_device)
-        st = SyncthingManager(APIInfo['APIkey'], APIInfo['Hostname'], APIInfo['Port'])
+        api = getAPIInfo(args.config, args.config_device)
+    except SyncthingManagerError as err:
+        print(err)
+        sys.exit(1)
+    # Only the actions below talk to the daemon.
+    from syncthing import SyncthingError
+    try:
+        st = SyncthingManager(api.apikey, api.hostname, api.port)
         if args.subparser_name == 'device':
             if args.deviceparser_name == 'add':
                 st.add_device(args.deviceID, args.name, args.address,
@@ -857,16 +1415,22 @@ def main():
             elif args.deviceparser_name == 'list':
                 st._device_list()
             elif args.deviceparser_name == 'edit':
-                if args.name:
-                    st.device_change_name(args.device, args.name)
-                if args.introducer:
-                    st.edit_device(args.device, 'introducer', True)
-                if args.introducer_off:
-                    st.edit_device(args.device, 'introducer', False)
-                if args.add_address:
-                    st.device_add_address(args.device, args.add_address)
-                if args.remove_address:
-                    st.device_remove_address(args.device, args.remove_address)
+                with st.batch():
+                    if args.introducer:
+                        st.edit_device(args.device, 'introducer', True)
+                    if args.introducer_off:
+                        st.edit_device(args.device, 'introducer', False)
+                    if args.compression:
+                        st.edit_device(args.device, 'compression',
+                                args.compression)
+                    if args.add_address:
+                        st.device_add_address(args.device, args.add_address)
+                    if args.remove_address:
+                        st.device_remove_address(args.device,
+                                args.remove_address)
+                    # Last, since the old name no longer finds the device
+                    if args.name:
+                        st.device_change_name(args.device, args.name)
         elif args.subparser_name == 'daemon':
             if args.pause:
                 st.daemon_pause(args.pause)
@@ -887,20 +1451,21 @@ def main():
             elif args.folderparser_name == 'unshare':
                 st.unshare_folder(args.folder, args.device)
             elif args.folderparser_name == 'edit':
+                changes = {}
                 if args.label:
-                    st.folder_set_label(args.folder, args.label)
+                    changes['label'] = args.label
                 if args.rescan:
-                    st.folder_set_rescan(args.folder, args.rescan)
+                    changes['rescanIntervalS'] = args.rescan
                 if args.minfree:
-                    st.folder_set_minfree(args.folder, args.minfree)
+                    changes['minDiskFreePct'] = args.minfree
                 if args.folder_type:
-                    st.folder_set_type(args.folder, args.folder_type)
+                    changes['type'] = args.folder_type
                 if args.order:
-                    st.folder_set_order(args.folder, args.order)
-                if args.ignore_permissions:
-                    st.folder_set_ignore_perms(args.folder, args.ignore_permissions)
-                if args.sync_permissions:
-                    st.folder_set_ignore_perms(args.folder, False)
+                    changes['order'] = args.order
+                if args.ignore_permissions or args.sync_permissions:
+                    changes['ignorePerms'] = args.ignore_permissions
+                if changes:
+                    st.folder_edit_batch(args.folder, **changes)
             elif args.folderparser_name == 'versioning':
                 if args.versionparser_name == 'trashcan':
                     st.folder_setup_versioning_trashcan(args.folder, args.cleanout)
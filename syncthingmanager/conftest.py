@@ -1,3 +1,5 @@
+import copy
+
 import syncthingmanager as stman
 import pytest
 
@@ -5,12 +7,19 @@ import pytest
 def temp_folder(tmpdir_factory):
     return tmpdir_factory.mktemp('stmantest1')
 
+@pytest.fixture(scope='session')
+def api_info():
+    return stman.getAPIInfo(stman.__DEFAULT_CONFIG_LOCATION__)
+
+@pytest.fixture(scope='session')
+def baseline_cfg(api_info):
+    s = stman.SyncthingManager(api_info.apikey, api_info.hostname, api_info.port)
+    return s.system.config()
+
 @pytest.fixture()
-def s(request, temp_folder):
-    APIInfo = stman.getAPIInfo(stman.__DEFAULT_CONFIG_LOCATION__)
-    s = stman.SyncthingManager(APIInfo['APIkey'], APIInfo['Hostname'], APIInfo['Port'])
-    cfg = s.system.config()
-    cfga = s.system.config()
+def s(request, temp_folder, api_info, baseline_cfg):
+    s = stman.SyncthingManager(api_info.apikey, api_info.hostname, api_info.port)
+    cfg = copy.deepcopy(baseline_cfg)
     test_device = {'deviceID': 'MFZWI3D-BONSGYC-YLTMRWG-C43ENR5-QXGZDMM-FZWI3DP-BONSGYY-LTMRWAD',
             'name': 'SyncthingManagerTestDevice1', 'addresses': ['localhost']}
     test_folder = {'id': 'stmantest1', 'label': 'SyncthingManagerTestFolder1',
@@ -20,5 +29,4 @@ def s(request, temp_folder):
     cfg['folders'].append(test_folder)
     s.system.set_config(cfg)
     yield s
-    cfg = cfga
-    s.system.set_config(cfg)
+    s.system.set_config(baseline_cfg)
@@ -1,185 +1,203 @@
+import subprocess
+import sys
+import time
 from unittest import TestCase
 
+import pytest
+
+import syncthingmanager
+from syncthingmanager import SyncthingManagerError
+
 def device1_info(s):
     cfg = s.system.config()
-    a = filter(lambda x: x['name'] == 'SyncthingManagerTestDevice1', cfg['devices'])
-    return a
+    return {d['name']: d for d in cfg['devices']}.get('SyncthingManagerTestDevice1')
 
 def folder1_info(s):
     cfg = s.system.config()
-    a = filter(lambda x: x['id'] == 'stmantest1', cfg['folders']) 
-    return a
+    return {f['id']: f for f in cfg['folders']}.get('stmantest1')
 
 def test_device_info(s):
     tc = TestCase()
     info = s.device_info('SyncthingManagerTestDevice1')
-    tc.assertCountEqual(['id', 'index', 'folders', 'name'], list(info.keys()))
-    assert info['index'] != None
-    assert info['folders'] == []
+    tc.assertCountEqual(['id', 'index', 'folders', 'name'], list(info._fields))
+    assert info.index != None
+    assert info.folders == []
+
+def test_device_info_folders(s):
+    s.add_device('MRIW7OK-NETT3M4-N6SBWME-N25O76W-YJKVXPH-FUMQJ3S-P57B74J-GBITBAC',
+            'SyncthingManagerTestDevice2')
+    s.share_folder('stmantest1', 'SyncthingManagerTestDevice1')
+    assert s.device_info('SyncthingManagerTestDevice1').folders == ['stmantest1']
+    assert s.device_info('MFZWI3D-BONSGYC-YLTMRWG-C43ENR5-QXGZDMM-FZWI3DP-BONSGYY-LTMRWAD').folders == ['stmantest1']
+    assert s.device_info('SyncthingManagerTestDevice2').folders == []
 
 def test_folder_info(s):
     tc = TestCase()
     info = s.folder_info('SyncthingManagerTestFolder1')
-    tc.assertCountEqual(['id', 'index', 'devices', 'label'], list(info.keys()))
-    assert len(info['devices']) == 1
+    tc.assertCountEqual(['id', 'index', 'devices', 'label'], list(info._fields))
+    assert len(info.devices) == 1
     info = s.folder_info('stmantest1')
-    tc.assertCountEqual(['id', 'index', 'devices', 'label'], list(info.keys()))
+    tc.assertCountEqual(['id', 'index', 'devices', 'label'], list(info._fields))
 
 def test_add_device(s):
     s.add_device('MRIW7OK-NETT3M4-N6SBWME-N25O76W-YJKVXPH-FUMQJ3S-P57B74J-GBITBAC',
             'SyncthingManagerTestDevice2', '127.0.0.1', True, True)
     cfg = s.system.config()
-    found = False
-    for device in cfg['devices']:
-        if device['deviceID'] == 'MRIW7OK-NETT3M4-N6SBWME-N25O76W-YJKVXPH-FUMQJ3S-P57B74J-GBITBAC':
-            found = True
-            assert device['introducer']
-            assert 'dynamic' in device['addresses']
-    assert found
+    devices = {d['deviceID']: d for d in cfg['devices']}
+    device = devices['MRIW7OK-NETT3M4-N6SBWME-N25O76W-YJKVXPH-FUMQJ3S-P57B74J-GBITBAC']
+    assert device['introducer']
+    assert 'dynamic' in device['addresses']
 
 def test_remove_device(s):
-    a = device1_info(s)
     s.remove_device('SyncthingManagerTestDevice1')
-    b = device1_info(s)
-    assert not next(b, False)
+    assert device1_info(s) is None
 
 def test_edit_device(s):
-    a = next(device1_info(s))
+    a = device1_info(s)
     s.edit_device('SyncthingManagerTestDevice1', 'introducer', True)
     s.edit_device('SyncthingManagerTestDevice1', 'compression', 'always')
     address = ['tcp://127.0.0.2:8384']
     s.edit_device('SyncthingManagerTestDevice1', 'addresses', address)
-    b = next(device1_info(s))
+    b = device1_info(s)
     assert b['introducer']
     assert a['compression'] != 'always'
     assert b['compression'] == 'always'
     assert b['addresses'] == address
 
 def test_device_add_address(s):
-    a = next(device1_info(s))
+    a = device1_info(s)
     s.device_add_address('SyncthingManagerTestDevice1', 'tcp://127.0.0.2:8384')
-    b = next(device1_info(s))
+    b = device1_info(s)
     assert 'tcp://127.0.0.2:8384' not in a['addresses']
     assert 'tcp://127.0.0.2:8384' in b['addresses']
 
 def test_device_remove_address(s):
-    a = next(device1_info(s))
+    a = device1_info(s)
     s.device_remove_address('SyncthingManagerTestDevice1', 'localhost')
-    b = next(device1_info(s))
+    b = device1_info(s)
     assert 'localhost' in a['addresses']
     assert 'localhost' not in b['addresses']
 
 def test_device_change_name(s):
-    a = next(device1_info(s))
+    a = device1_info(s)
     s.device_change_name('SyncthingManagerTestDevice1', 'SyncthingManagerTestDevice2')
-    b = next(filter(lambda x: x['name'] == 'SyncthingManagerTestDevice2', s.system.config()['devices']))
-    assert b['name'] == 'SyncthingManagerTestDevice2'
+    devices = {d['name']: d for d in s.system.config()['devices']}
+    assert 'SyncthingManagerTestDevice2' in devices
+    assert devices['SyncthingManagerTestDevice2']['deviceID'] == a['deviceID']
 
 def test_add_folder(s, temp_folder):
     p = temp_folder
     s.add_folder(str(p), 'stmantest2', 'SyncthingManagerTestFolder2', 'readonly', 40)
     cfg = s.system.config()
-    found = False
-    for folder in cfg['folders']:
-        if folder['id'] == 'stmantest2':
-            found = True
-            assert folder['type'] == 'readonly'
-            assert folder['rescanIntervalS'] == 40
-    assert found
+    folder = {f['id']: f for f in cfg['folders']}['stmantest2']
+    assert folder['type'] == 'readonly'
+    assert folder['rescanIntervalS'] == 40
 
 def test_remove_folder(s):
-    a = folder1_info(s)
-    assert next(a, False)
+    assert folder1_info(s)
     s.remove_folder('stmantest1')
-    b = folder1_info(s)
-    assert not next(b, False)
+    assert folder1_info(s) is None
 
 def test_share_folder(s):
     a = folder1_info(s)
     s.share_folder('stmantest1', 'SyncthingManagerTestDevice1')
     b = folder1_info(s)
-    assert len(next(a)['devices']) == 1
-    assert len(next(b)['devices']) == 2
+    assert len(a['devices']) == 1
+    assert len(b['devices']) == 2
+
+def test_share_folder_multiple(s):
+    s.add_device('MRIW7OK-NETT3M4-N6SBWME-N25O76W-YJKVXPH-FUMQJ3S-P57B74J-GBITBAC',
+            'SyncthingManagerTestDevice2')
+    s.share_folder('stmantest1', ['SyncthingManagerTestDevice1',
+        'SyncthingManagerTestDevice2'])
+    a = folder1_info(s)
+    assert len(a['devices']) == 3
+
+def test_unshare_folder(s):
+    s.share_folder('stmantest1', 'SyncthingManagerTestDevice1')
+    s.unshare_folder('stmantest1', ['SyncthingManagerTestDevice1'])
+    a = folder1_info(s)
+    assert len(a['devices']) == 1
 
 def test_folder_edit(s):
-    a = next(folder1_info(s))
+    a = folder1_info(s)
     s.folder_edit('stmantest1', 'label', 'SyncthingManagerTestFolder2')
-    b = next(folder1_info(s))
+    b = folder1_info(s)
     assert a['label'] == 'SyncthingManagerTestFolder1'
     assert b['label'] == 'SyncthingManagerTestFolder2'
 
 def test_folder_set_label(s):
-    a = next(folder1_info(s))
+    a = folder1_info(s)
     s.folder_set_label('stmantest1', 'SyncthingManagerTestFolder2')
-    b = next(folder1_info(s))
+    b = folder1_info(s)
     assert a['label'] == 'SyncthingManagerTestFolder1'
     assert b['label'] == 'SyncthingManagerTestFolder2'
 
 def test_folder_set_rescan(s):
-    a = next(folder1_info(s))
+    a = folder1_info(s)
     s.folder_set_rescan('stmantest1', 40)
-    b = next(folder1_info(s))
+    b = folder1_info(s)
     assert a['rescanIntervalS'] == 60
     assert b['rescanIntervalS'] == 40
 
 def test_folder_set_minfree(s):
-    a = next(folder1_info(s))
+    a = folder1_info(s)
     s.folder_set_minfree('stmantest1', 5)
-    b = next(folder1_info(s))
+    b = folder1_info(s)
     assert a['minDiskFreePct'] == 0
     assert b['minDiskFreePct'] == 5
 
 def test_folder_set_type(s):
-    a = next(folder1_info(s))
+    a = folder1_info(s)
     s.folder_set_type('stmantest1', 'readonly')
-    b = next(folder1_info(s))
+    b = folder1_info(s)
     assert a['type'] == 'readwrite'
     assert b['type'] == 'readonly'
 
 def test_folder_set_order(s):
-    a = next(folder1_info(s))
+    a = folder1_info(s)
     s.folder_set_order('stmantest1', 'alphabetic')
-    b = next(folder1_info(s))
+    b = folder1_info(s)
     assert a['order'] == 'random'
     assert b['order'] == 'alphabetic'
 
 def test_folder_set_ignore_perms(s):
-    a = next(folder1_info(s))
+    a = folder1_info(s)
     s.folder_set_ignore_perms('stmantest1', True)
-    b = next(folder1_info(s))
+    b = folder1_info(s)
     assert not a['ignorePerms']
     assert b['ignorePerms']
 
 def test_folder_setup_versioning_trashcan(s):
-    a = next(folder1_info(s))
+    a = folder1_info(s)
     s.folder_setup_versioning_trashcan('stmantest1', 9)
-    b = next(folder1_info(s))
+    b = folder1_info(s)
     assert b['versioning'] == {'params': {'cleanoutDays': '9'}, 'type':
         'trashcan'}
 
 def test_folder_setup_versioning_simple(s):
-    a = next(folder1_info(s))
+    a = folder1_info(s)
     s.folder_setup_versioning_simple('stmantest1', 6)
-    b = next(folder1_info(s))
+    b = folder1_info(s)
     assert b['versioning'] == {'params': {'keep': '6'}, 'type': 'simple'}
 
 def test_folder_setup_versioning_staggered(s):
-    a = next(folder1_info(s))
+    a = folder1_info(s)
     s.folder_setup_versioning_staggered('stmantest1', 365, 'versions')
-    b = next(folder1_info(s))
+    b = folder1_info(s)
     assert b['versioning'] == {'params': {'maxAge': '31536000', 'cleanInterval': '3600',
         'versionsPath': 'versions'}, 'type': 'staggered'}
 
 def test_folder_setup_versioning_external(s):
-    a = next(folder1_info(s))
+    a = folder1_info(s)
     s.folder_setup_versioning_external('stmantest1', 'rm -r')
-    b = next(folder1_info(s))
+    b = folder1_info(s)
     assert b['versioning'] == {'params': {'command': 'rm -r'}, 'type': 'external'}
 
 def test_folder_setup_versioning_none(s):
-    a = next(folder1_info(s))
+    a = folder1_info(s)
     s.folder_setup_versioning_none('stmantest1')
-    b = next(folder1_info(s))
+    b = folder1_info(s)
     assert b['versioning'] == {'params': {}, 'type': ''}
 
 def test_daemon_pause(s):
@@ -196,3 +214,153 @@ def test_daemon_resume(s):
 def test_db_sync_fraction(s):
     a = s.db_folder_sync_fraction('stmantest1')
     assert isinstance(a, float) or isinstance(a, int)
+
+def test_fetch_state(s):
+    config, status = s._fetch_state('config', 'status')
+    assert config['devices'] == s.system.config()['devices']
+    assert status['myID'] == s.system.status()['myID']
+    assert s._fetch_state('config')[0] is config
+
+def test_get_config_force(s):
+    config = s._get_config()
+    assert s._get_config() is config
+    s.folder_info('stmantest1').devices.append('nonexistent')
+    assert 'nonexistent' not in s.folder_info('stmantest1').devices
+    config['folders'][0]['label'] = 'changed'
+    fresh = s._get_config(force=True)
+    assert fresh is not config
+    assert fresh['folders'][0]['label'] != 'changed'
+
+def test_batch(s):
+    with s.batch():
+        s.folder_set_rescan('stmantest1', 30)
+        s.folder_set_order('stmantest1', 'alphabetic')
+        a = folder1_info(s)
+        assert a['rescanIntervalS'] == 60
+    b = folder1_info(s)
+    assert b['rescanIntervalS'] == 30
+    assert b['order'] == 'alphabetic'
+
+def test_batch_error(s):
+    with pytest.raises(SyncthingManagerError):
+        with s.batch():
+            s.folder_set_rescan('stmantest1', 30)
+            s.folder_set_label('nonexistent', 'label')
+    a = folder1_info(s)
+    assert a['rescanIntervalS'] == 60
+
+def test_sniff_subcommand():
+    sniff = syncthingmanager._sniff_subcommand
+    assert sniff(['device', 'list']) == 'device'
+    assert sniff(['-c', 'folder', '--device', 'daemon', 'folder', 'list']) == 'folder'
+    assert sniff(['-h']) is None
+    assert sniff(['--config=stman.conf', 'daemon', '-p', 'x']) == 'daemon'
+    assert sniff(['devices']) is None
+    assert sniff(['--conf', 'device', 'folder', 'list']) == 'folder'
+    assert sniff(['--dev=x', '-cstman.conf', 'device', 'list']) == 'device'
+    assert sniff(['--verbose', 'device', 'list']) is None
+    assert sniff(['--he']) is None
+    assert sniff([]) is None
+
+def test_lazy_imports():
+    code = ('import sys, syncthingmanager; print(" ".join(m for m in '
+            '("syncthing", "requests", "configparser", "argparse", '
+            '"xml.etree.ElementTree") if m in sys.modules))')
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert out.strip() == b''
+
+def test_getAPIInfo_modified(tmpdir):
+    conf = tmpdir.join('stman.conf')
+    conf.write('[DEFAULT]\nname = a\n\n[a]\napikey = k\nhostname = h\nport = 1\n')
+    assert syncthingmanager.getAPIInfo(str(conf)).port == 1
+    conf.write('[DEFAULT]\nname = a\n\n[a]\napikey = k\nhostname = h\nport = 2\n')
+    conf.setmtime(conf.mtime() + 10)
+    assert syncthingmanager.getAPIInfo(str(conf)).port == 2
+
+def test_folder_edit_batch(s):
+    s.folder_edit_batch('SyncthingManagerTestFolder1', label='SyncthingManagerTestFolder2',
+            rescanIntervalS=30)
+    a = folder1_info(s)
+    assert a['label'] == 'SyncthingManagerTestFolder2'
+    assert a['rescanIntervalS'] == 30
+
+def test_read_st_apikey(tmpdir):
+    stconfig = tmpdir.join('config.xml')
+    stconfig.write('<configuration><folder><apikey>no</apikey></folder>'
+            '<gui><address>127.0.0.1:8384</address><apikey>key</apikey></gui>'
+            '<options><unterminated')
+    assert syncthingmanager._read_st_apikey(str(stconfig)) == 'key'
+    stconfig.write('<configuration><gui></gui></configuration>')
+    assert syncthingmanager._read_st_apikey(str(stconfig)) is None
+
+def test_configure(tmpdir):
+    conf = str(tmpdir.join('stman.conf'))
+    syncthingmanager.configure(conf, 'key1', 'localhost', 8384, 'a', False)
+    assert syncthingmanager.getAPIInfo(conf).apikey == 'key1'
+    syncthingmanager.configure(conf, 'key2', 'localhost', 8384, 'a', False)
+    assert syncthingmanager.getAPIInfo(conf).apikey == 'key2'
+    assert tmpdir.listdir() == [tmpdir.join('stman.conf')]
+
+def test_configure_symlink(tmpdir):
+    real = tmpdir.mkdir('real').join('stman.conf')
+    syncthingmanager.configure(str(real), 'key1', 'localhost', 8384, 'a', False)
+    real.chmod(0o644)
+    link = tmpdir.join('stman.conf')
+    link.mksymlinkto(real)
+    syncthingmanager.configure(str(link), 'key2', 'localhost', 8384, 'a', False)
+    assert link.islink()
+    assert syncthingmanager.getAPIInfo(str(real)).apikey == 'key2'
+    assert real.stat().mode & 0o777 == 0o644
+    assert real.dirpath().listdir() == [real]
+
+def slow_fetcher(s, calls):
+    fetcher = s._fetcher
+    def fetch(endpoint):
+        calls.append(endpoint)
+        time.sleep(0.05)
+        return fetcher(endpoint)()
+    return lambda endpoint: lambda: fetch(endpoint)
+
+def test_cached_slow_response(s):
+    calls = []
+    s._fetcher = slow_fetcher(s, calls)
+    s._CACHE_TTL = 0.03
+    s._get_status()
+    s._get_status()
+    assert calls == ['status']
+
+def test_fetch_state_slow_response(s):
+    calls = []
+    s._fetcher = slow_fetcher(s, calls)
+    s._CACHE_TTL = 0.03
+    s._fetch_state('status', 'connections')
+    assert sorted(calls) == ['connections', 'status']
+
+def test_folder_list_fetches_config_once(s, capsys):
+    calls = []
+    s._fetcher = slow_fetcher(s, calls)
+    s._CACHE_TTL = -1
+    s._folder_list()
+    assert sorted(calls) == ['config', 'status']
+
+def test_batch_nested_error(s):
+    with s.batch():
+        s.folder_set_rescan('stmantest1', 30)
+        with pytest.raises(SyncthingManagerError):
+            with s.batch():
+                s.folder_set_order('stmantest1', 'alphabetic')
+                s.folder_set_label('nonexistent', 'label')
+        s.folder_set_label('stmantest1', 'changed')
+    a = folder1_info(s)
+    assert a['rescanIntervalS'] == 60
+    assert a['order'] != 'alphabetic'
+    assert a['label'] != 'changed'
+    with s.batch():
+        s.folder_set_rescan('stmantest1', 30)
+    assert folder1_info(s)['rescanIntervalS'] == 30
+
+def test_add_folder_then_share(s, temp_folder):
+    s.add_folder(str(temp_folder), 'stmantest2')
+    assert s.folder_info('stmantest2').devices
+    s.share_folder('stmantest2', 'SyncthingManagerTestDevice1')
+    assert len(s.folder_info('stmantest2').devices) == 2